@@ -1,7 +1,26 @@
-from typing import Optional, Any, List
+import math
+from typing import Any, Tuple
 
 
+# Operations store their name as a small int, the
+# passes compare those instead of strings
+OP_ADD = 0
+OP_MUL = 1
+OP_GETARG = 2
+OP_DUMMY = 3
+OP_LSHIFT = 4
+
+_OPNAMES = ["add", "mul", "getarg", "dummy", "lshift"]
+_OPCODES = {name: opcode for opcode, name in enumerate(_OPNAMES)}
+
 class Value:
+    # Operation and Constant must not be
+    # subclassed: to keep the hot paths cheap, the
+    # code checks type(x) is Operation or
+    # type(x) is Constant, which is a single
+    # pointer comparison, instead of isinstance
+    __slots__ = ()
+
     def find(self):
         raise NotImplementedError("abstract")
     def _set_forwarded(self, value):
@@ -9,11 +28,22 @@ class Value:
 
 
 class Operation(Value):
-    def __init__(self, name: str, args: List[Value]):
-        self.name = name
+    __slots__ = ("opcode", "args", "forwarded")
+
+    def __init__(self, opcode: int, args: Tuple[Value, ...]):
+        self.opcode = opcode
+        # the arguments never change after
+        # construction, a tuple stores them inline
+        # in a single object instead of a list
+        # header plus a separately allocated,
+        # over-allocated item array
         self.args = args
         self.forwarded = None
 
+    @property
+    def name(self) -> str:
+        return _OPNAMES[self.opcode]
+
     def __repr__(self):
         return (
             f"Operation({self.name},"
@@ -23,15 +53,34 @@ class Operation(Value):
     def find(self) -> Value:
         # returns the "representative" value of
         # self, in the union-find sense
+        next = self.forwarded
+        if next is None:
+            return self
+        # after path compression (see below) the
+        # forwarded field is a cache of the last
+        # result: unless the representative was
+        # unified with something else since then,
+        # it is still the representative
+        if type(next) is not Operation or \
+                next.forwarded is None:
+            return next
         op = self
-        while isinstance(op, Operation):
-            # could do path compression here too
-            # but not essential
+        while type(op) is Operation:
             next = op.forwarded
             if next is None:
-                return op
+                break
             op = next
-        return op
+        root = op
+        # path compression: point every Operation
+        # on the chain we just walked directly at
+        # the representative, so the next find()
+        # is a single hop
+        op = self
+        while op is not root:
+            next = op.forwarded
+            op.forwarded = root
+            op = next
+        return root
 
     def arg(self, index):
         # change to above: return the
@@ -45,14 +94,25 @@ class Operation(Value):
         # must be either a Constant or an operation
         # that we know for sure is not optimized
         # away.
-
-        self.find()._set_forwarded(value)
+        #
+        # Because of that there is no union by rank
+        # here: the root of self is always forwarded
+        # to the root of value, never the other way
+        # around. Path compression in find() keeps
+        # the chains short anyway.
+        root = self.find()
+        value = value.find()
+        if root is value:
+            return
+        root._set_forwarded(value)
 
     def _set_forwarded(self, value: Value):
         self.forwarded = value
 
 
 class Constant(Value):
+    __slots__ = ("value",)
+
     def __init__(self, value: Any):
         self.value = value
 
@@ -67,19 +127,86 @@ class Constant(Value):
         # equal to a constant, it's a compiler bug
         # to find out that it's equal to another
         # constant
-        assert isinstance(value, Constant) and \
+        assert type(value) is Constant and \
             value.value == self.value
 
 
+_CONST_CACHE = {}
+
+def const_key(value: Any):
+    # The key under which equal constants are the
+    # same. The type is part of it, otherwise e.g.
+    # 1, 1.0 and True would all be one constant,
+    # and so is the sign of a float zero, because
+    # 0.0 == -0.0. Returns None for values that
+    # cannot be keyed: NaN is not equal to
+    # anything, and unhashable values cannot go
+    # into a dict.
+    t = type(value)
+    if t is float:
+        if value != value:
+            return None
+        if value == 0.0:
+            return (t, value, math.copysign(1.0, value))
+    key = (t, value)
+    try:
+        hash(key)
+    except TypeError:
+        return None
+    return key
+
+def make_const(value: Any) -> Constant:
+    # Constants are immutable, so we hand out one
+    # shared instance per value instead of
+    # allocating a new one every time. Values
+    # without a const_key are not shared.
+    key = const_key(value)
+    if key is None:
+        return Constant(value)
+    const = _CONST_CACHE.get(key)
+    if const is None:
+        const = Constant(value)
+        _CONST_CACHE[key] = const
+    return const
+
+CONST_ZERO = make_const(0)
+CONST_ONE = make_const(1)
+
+
+def wraparg(arg) -> Value:
+    # Constants are replaced by the shared
+    # instance from make_const
+    t = type(arg)
+    if t is Constant:
+        return make_const(arg.value)
+    if t is not Operation:
+        arg = make_const(arg)
+    return arg 
+
+
 class Block(list):
     def opbuilder(opname: str):
-        def wraparg(arg):
-            if not isinstance(arg, Value):
-                arg = Constant(arg)
-            return arg 
+        opcode = _OPCODES[opname]
+        commutative = opcode == OP_ADD or opcode == OP_MUL
 
         def build(self, *args):
-            op = Operation(opname, [wraparg(arg) for arg in args])
+            # args is already a tuple and can be
+            # stored as it is, it is only copied if
+            # an argument has to be wrapped, which
+            # most arguments (Operations) don't
+            for arg in args:
+                if type(arg) is not Operation:
+                    args = tuple(map(wraparg, args))
+                    break
+            # put the arguments of commutative
+            # operations into a canonical order,
+            # constants go to the right:
+            # add(5, x) is built as add(x, 5)
+            if commutative and len(args) == 2 and \
+                    type(args[0]) is Constant and \
+                    type(args[1]) is not Constant:
+                args = (args[1], args[0])
+            op = Operation(opcode, args)
             self.append(op)
             return op
         return build
@@ -91,18 +218,54 @@ class Block(list):
     lshift = opbuilder("lshift")
 
 
+class OptimisingBlock(Block):
+    # A Block that applies the rules of optimise
+    # to every add while it is being built, so
+    # the block never contains the unoptimized
+    # operations and no extra pass over it is
+    # needed. Instead of the new Operation, add
+    # returns whatever the result is equal to,
+    # which can be an earlier Operation or a
+    # Constant.
+
+    def __init__(self):
+        super().__init__()
+        # the same table optimise uses for cse
+        self.seen = {}
+
+    def add(self, arg0, arg1) -> Value:
+        result, emit = _simplify_add(
+            wraparg(arg0).find(), wraparg(arg1).find(),
+            self.seen)
+        if emit is not None:
+            self.append(emit)
+        return result
+
+    def lshift(self, arg0, arg1) -> Value:
+        result, emit = _simplify_lshift(
+            wraparg(arg0).find(), wraparg(arg1).find(),
+            self.seen)
+        if emit is not None:
+            self.append(emit)
+        return result
+
+
 def constfold(bb: Block) -> Block:
     opt_bb = Block()
+    emit = opt_bb.append
 
     for op in bb:
-        if op.name == "add":
+        if op.opcode == OP_ADD:
             arg0 = op.arg(0) # uses .find()
-            arg1 = op.arg(1) # uses .find()
-            if isinstance(arg0, Constant) and isinstance(arg1, Constant):
-                value = arg0.value + arg1.value
-                op.make_equal_to(Constant(value))
-                continue
-        opt_bb.append(op)
+            # only look at the second argument if
+            # the first one is a constant
+            if type(arg0) is Constant:
+                arg1 = op.arg(1) # uses .find()
+                if type(arg1) is Constant:
+                    value = arg0.value + arg1.value
+                    op.make_equal_to(make_const(value))
+                    continue
+        emit(op)
     return opt_bb
 
 
@@ -110,48 +273,63 @@ def constfold(bb: Block) -> Block:
 
 def common_subexpr_elimination(bb: Block) -> Block: 
     opt_bb = Block()
+    # maps the key of every add we emitted to
+    # that add, see add_key below
+    seen = {}
     for op in bb: 
-        if op.name == "add":
-            arg0 = op.arg(0)
-            arg1 = op.arg(1) 
-            prev_op = find_prev_add_op(arg0, arg1, opt_bb)
+        if op.opcode == OP_ADD:
+            key = add_key(op.arg(0), op.arg(1))
+            prev_op = seen.get(key)
             if prev_op is not None: 
                 op.make_equal_to(prev_op)
                 continue
+            seen[key] = op
         opt_bb.append(op)
     return opt_bb
 
 def eq_value(val0, val1):
-    if isinstance(val0, Constant) and isinstance(val1, Constant):
+    # Constants made by make_const are shared, so
+    # most equal values are the same object
+    if val0 is val1:
+        return True
+    if type(val0) is Constant and type(val1) is Constant:
         return val0.value == val1.value
 
-    return val0 is val1
-
-def find_prev_add_op(arg0: Value, arg1: Value,
-        opt_bb: Block) -> Optional[Operation]:
-    # Really naive and quadratic implementation.
-    # What we do is walk over the already emitted
-    # operations and see whether we emitted an add
-    # with the current arguments already. A real
-    # implementation might use a hashmap of some
-    # kind, or at least only look at a limited
-    # window of instructions.
-    for opt_op in opt_bb:
-        if opt_op.name != "add":
-            continue
-        # It's important to call arg here,
-        # for the same reason why we
-        # needed it in constfold: we need to
-        # make sure .find() is called
-        if eq_value(arg0, opt_op.arg(0)) and \
-                eq_value(arg1, opt_op.arg(1)):
-            return opt_op
-    return None
+    return False
+
+def value_key(value: Value):
+    # The value must already be a representative,
+    # i.e. the result of .find() or .arg().
+    # Operations are keyed by identity. Constants
+    # are keyed by their const_key, like in
+    # make_const: most of them are shared, but
+    # e.g. one passed to make_equal_to directly
+    # need not be. Constants without a const_key
+    # can only be keyed by identity.
+    if type(value) is Constant:
+        key = const_key(value.value)
+        if key is not None:
+            return key
+    return id(value)
+
+def add_key(arg0: Value, arg1: Value):
+    # Instead of walking over the already emitted
+    # operations to find an add with the same
+    # arguments, we look it up in a dict keyed by
+    # the arguments. add is commutative, so the
+    # two argument keys go into a frozenset, that
+    # way add(x, y) and add(y, x) get the same key.
+    return (OP_ADD, frozenset((value_key(arg0), value_key(arg1))))
+
+def lshift_key(arg0: Value, arg1: Value):
+    # like add_key, but the order of the arguments
+    # matters
+    return (OP_LSHIFT, value_key(arg0), value_key(arg1))
 
 def strength_reduce(bb: Block) -> Block:
     opt_bb = Block()
     for op in bb:
-        if op.name == "add":
+        if op.opcode == OP_ADD:
             arg0 = op.arg(0)
             arg1 = op.arg(1)
             if arg0 is arg1:
@@ -162,45 +340,115 @@ def strength_reduce(bb: Block) -> Block:
         opt_bb.append(op)
     return opt_bb
 
+def _simplify_add(arg0: Value, arg1: Value, seen: dict,
+        op: Operation = None):
+    # The rules for an add of arg0 and arg1, which
+    # must already be representatives. They are
+    # shared by optimise, where op is the add being
+    # optimized, and OptimisingBlock, where op is
+    # None and the add is only created if it is
+    # needed. Returns a pair: the value the add is
+    # equal to, and the operation that has to be
+    # emitted for it (None if nothing has to be).
+
+    # constant folding
+    if type(arg0) is Constant and \
+            type(arg1) is Constant:
+        value = arg0.value + arg1.value
+        return make_const(value), None
+
+    # cse
+    key = add_key(arg0, arg1)
+    prev_op = seen.get(key)
+    if prev_op is not None:
+        return prev_op, None
+
+    # strength reduce:
+    # x + x turns into x << 1
+    # the lshift goes into the cse table too, so
+    # another x + x reuses it
+    if arg0 is arg1:
+        return _simplify_lshift(arg0, CONST_ONE, seen)
+
+    # and while we are at it, let's do some
+    # arithmetic simplification:
+    # a + 0 => a
+    if eq_value(arg0, CONST_ZERO):
+        return arg1, None
+    if eq_value(arg1, CONST_ZERO):
+        return arg0, None
+
+    if op is None:
+        # canonical order, like in Block
+        if type(arg0) is Constant:
+            arg0, arg1 = arg1, arg0
+        op = Operation(OP_ADD, (arg0, arg1))
+    seen[key] = op
+    return op, op
+
+def _simplify_lshift(arg0: Value, arg1: Value, seen: dict,
+        op: Operation = None):
+    # like _simplify_add, for lshift
+    key = lshift_key(arg0, arg1)
+    prev_op = seen.get(key)
+    if prev_op is not None:
+        return prev_op, None
+    if op is None:
+        op = Operation(OP_LSHIFT, (arg0, arg1))
+    seen[key] = op
+    return op, op
+
+def _handle_add(op: Operation, seen: dict):
+    # the same as op.arg(0) and op.arg(1),
+    # without the extra call for each
+    args = op.args
+    result, emit = _simplify_add(
+        args[0].find(), args[1].find(), seen, op)
+    if result is not op:
+        op.make_equal_to(result)
+    return emit
+
+def _handle_lshift(op: Operation, seen: dict):
+    result, emit = _simplify_lshift(
+        op.arg(0), op.arg(1), seen, op)
+    if result is not op:
+        op.make_equal_to(result)
+    return emit
+
+# The rules of optimise, per opcode. A handler gets
+# the operation and the cse table and returns the
+# operation to emit in its place (usually the
+# operation itself), or None if it was optimized
+# away. Operations without a handler are emitted
+# unchanged.
+HANDLERS = {
+    OP_ADD: _handle_add,
+    OP_LSHIFT: _handle_lshift,
+}
+
 def optimise(bb: Block) -> Block:
+    # every operation is replaced by at most one
+    # operation, so the result is never longer
+    # than bb: allocate it at full size once and
+    # cut off the unused tail at the end, instead
+    # of growing it step by step
     opt_bb = Block()
+    opt_bb.extend([None] * len(bb))
+    n = 0
+    seen = {}
+    # bound methods used once per operation are
+    # looked up only once, outside of the loop
+    get_handler = HANDLERS.get
 
     for op in bb:
-        if op.name == "add":
-            arg0 = op.arg(0)
-            arg1 = op.arg(1)
-
-            # constant folding
-            if isinstance(arg0, Constant) and \
-                    isinstance(arg1, Constant):
-                value = arg0.value + arg1.value
-                op.make_equal_to(Constant(value))
-                continue
-
-            # cse
-            prev_op = find_prev_add_op(
-                arg0, arg1, opt_bb)
-            if prev_op is not None:
-                op.make_equal_to(prev_op)
-                continue
-
-            # strength reduce:
-            # x + x turns into x << 1
-            if arg0 is arg1:
-                newop = opt_bb.lshift(arg0, 1)
-                op.make_equal_to(newop)
-                continue
-
-            # and while we are at it, let's do some
-            # arithmetic simplification:
-            # a + 0 => a
-            if eq_value(arg0, Constant(0)):
-                op.make_equal_to(arg1)
+        handler = get_handler(op.opcode)
+        if handler is not None:
+            op = handler(op, seen)
+            if op is None:
                 continue
-            if eq_value(arg1, Constant(0)):
-                op.make_equal_to(arg0)
-                continue
-        opt_bb.append(op)
+        opt_bb[n] = op
+        n += 1
+    del opt_bb[n:]
     return opt_bb
 
 def bb_to_str(bb: Block, varprefix: str = "var"):
@@ -208,16 +456,6 @@ def bb_to_str(bb: Block, varprefix: str = "var"):
     # look at the test below to see what the
     # result looks like
 
-    def arg_to_str(arg: Value):
-        if isinstance(arg, Constant):
-            return str(arg.value)
-        else:
-            # the key must exist, otherwise it's
-            # not a valid SSA basic block:
-            # the variable must be defined before
-            # its first use
-            return varnames[arg]
-
     varnames = {}
     res = []
     for index, op in enumerate(bb):
@@ -225,12 +463,18 @@ def bb_to_str(bb: Block, varprefix: str = "var"):
         # printing:
         var = f"{varprefix}{index}"
         varnames[op] = var
-        arguments = ", ".join(
-            arg_to_str(op.arg(i))
-                for i in range(len(op.args))
-        )
-        strop = f"{var} = {op.name}({arguments})"
-        res.append(strop)
+        parts = []
+        for arg in op.args:
+            arg = arg.find()
+            if type(arg) is Constant:
+                parts.append(str(arg.value))
+            else:
+                # the key must exist, otherwise it's
+                # not a valid SSA basic block:
+                # the variable must be defined before
+                # its first use
+                parts.append(varnames[arg])
+        res.append(f"{var} = {op.name}({', '.join(parts)})")
     return "\n".join(res)
 
 def test_convencience_block_construction():
@@ -241,9 +485,12 @@ def test_convencience_block_construction():
     a = bb.getarg(0)
     assert len(bb) == 1
     assert bb[0].name == "getarg"
+    assert bb[0].opcode == OP_GETARG
 
     # it's a Constant
     assert bb[0].args[0].value == 0
+    # and it is shared with every other 0
+    assert bb[0].args[0] is make_const(0)
 
     # b with getarg
     b = bb.getarg(1)
@@ -257,6 +504,27 @@ def test_convencience_block_construction():
     var4 = bb.add(var2, var3)
     assert len(bb) == 6
 
+    # constants of commutative operations are
+    # moved to the right
+    var5 = bb.add(1, var4)
+    assert var5.args[0] is var4
+    assert var5.args[1].value == 1
+    var6 = bb.mul(2, 3)
+    assert var6.args[0].value == 2
+    # only two arguments are ever swapped
+    var7 = bb.mul(5)
+    assert var7.args[0].value == 5
+    var8 = bb.add(1, var4, 2)
+    assert var8.args[0].value == 1
+    assert var8.args[1] is var4
+    assert var8.args[2].value == 2
+
+    # Constants passed in are replaced by the
+    # shared ones, too
+    bb = Block()
+    a = bb.getarg(Constant(0))
+    assert a.args[0] is make_const(0)
+
 def test_basicblock_to_str():
     bb = Block()
     var0 = bb.getarg(0)
@@ -337,6 +605,103 @@ def test_union_find():
     # union with the same constant again is fine
     a2.make_equal_to(c)
 
+def test_union_direction():
+    bb = Block()
+    a1 = bb.dummy(1)
+    a2 = bb.dummy(2)
+    a3 = bb.dummy(3)
+    b1 = bb.dummy(4)
+
+    a2.make_equal_to(a1)
+    a3.make_equal_to(a1)
+    assert a2.find() is a1
+    assert a3.find() is a1
+
+    # the argument always ends up as the
+    # representative, even if the set of self is
+    # the bigger one
+    a1.make_equal_to(b1)
+    assert a1.find() is b1
+    assert a2.find() is b1
+    assert a3.find() is b1
+    assert b1.find() is b1
+
+    # unifying something with itself does nothing
+    a3.make_equal_to(a2)
+    assert b1.find() is b1
+
+    # constants are always the representative
+    c = Constant(5)
+    b1.make_equal_to(c)
+    assert a1.find() is c
+    assert a3.find() is c
+
+def test_make_const():
+    assert make_const(5) is make_const(5)
+    # values that compare equal but have different
+    # types are different constants
+    assert make_const(1.0) is not make_const(1)
+    assert type(make_const(1.0).value) is float
+    assert type(make_const(True).value) is bool
+    assert make_const(-0.0) is not CONST_ZERO
+    # 0.0 == -0.0, but they are different floats
+    assert make_const(0.0) is make_const(0.0)
+    assert make_const(-0.0) is make_const(-0.0)
+    assert make_const(0.0) is not make_const(-0.0)
+    assert math.copysign(1.0, make_const(-0.0).value) == -1.0
+    # NaN is never shared
+    nan = float("nan")
+    assert make_const(nan) is not make_const(nan)
+
+    bb = OptimisingBlock()
+    assert math.copysign(1.0, bb.add(-0.0, -0.0).value) == -1.0
+    bb = Block()
+    bb.add(-0.0, -0.0)
+    assert bb_to_str(bb) == "var0 = add(-0.0, -0.0)"
+
+    # unhashable values still work, they are just
+    # not shared
+    assert make_const([1]).value == [1]
+    assert make_const([1]) is not make_const([1])
+    assert make_const((1, [2])) is not make_const((1, [2]))
+
+    bb = Block()
+    var0 = bb.getarg(0)
+    var1 = bb.add(var0, 1.0)
+    var2 = bb.getarg([1])
+    assert bb_to_str(bb) == """\
+var0 = getarg(0)
+var1 = add(var0, 1.0)
+var2 = getarg([1])"""
+
+def test_path_compression():
+    bb = Block()
+    a1 = bb.dummy(1)
+    a2 = bb.dummy(2)
+    a3 = bb.dummy(3)
+    a4 = bb.dummy(4)
+    # build a chain a4 -> a3 -> a2 -> a1 by hand
+    a4.forwarded = a3
+    a3.forwarded = a2
+    a2.forwarded = a1
+
+    assert a4.find() is a1
+    # after one find, everything on the path
+    # points straight at the representative
+    assert a4.forwarded is a1
+    assert a3.forwarded is a1
+    assert a2.forwarded is a1
+    assert a1.forwarded is None
+
+    # works when the representative is a constant
+    c = Constant(7)
+    b1 = bb.dummy(5)
+    b2 = bb.dummy(6)
+    b2.forwarded = b1
+    b1.forwarded = c
+    assert b2.find() is c
+    assert b2.forwarded is c
+
 def test_constfold_two_ops():
     # now it works!
     bb = Block()
@@ -367,7 +732,67 @@ optvar2 = add(optvar1, 17)
 optvar3 = mul(optvar0, optvar2)
 optvar4 = add(optvar3, optvar2)"""
 
+    # add is commutative, so the arguments can
+    # come in any order
+    bb = Block()
+    a = bb.getarg(0)
+    b = bb.getarg(1)
+    var2 = bb.add(a, b)
+    var3 = bb.add(b, a)
+    var4 = bb.add(17, var2)
+    var5 = bb.add(var3, 17)
+    var6 = bb.mul(var4, var5)
 
+    opt_bb = common_subexpr_elimination(bb)
+    assert bb_to_str(opt_bb, "optvar") == """\
+optvar0 = getarg(0)
+optvar1 = getarg(1)
+optvar2 = add(optvar0, optvar1)
+optvar3 = add(optvar2, 17)
+optvar4 = mul(optvar3, optvar3)"""
+
+
+def test_cse_forwarded_constants():
+    # Constants that come in through make_equal_to
+    # are not the shared ones from make_const, cse
+    # still has to treat equal ones as equal
+    bb = Block()
+    var0 = bb.getarg(0)
+    var1 = bb.dummy(1)
+    var2 = bb.dummy(2)
+    var1.make_equal_to(Constant(6))
+    var2.make_equal_to(Constant(6))
+    var3 = bb.add(var0, var1)
+    var4 = bb.add(var0, var2)
+    var5 = bb.mul(var3, var4)
+
+    opt_bb = common_subexpr_elimination(bb)
+    assert bb_to_str(opt_bb, "optvar") == """\
+optvar0 = getarg(0)
+optvar1 = dummy(1)
+optvar2 = dummy(2)
+optvar3 = add(optvar0, 6)
+optvar4 = mul(optvar3, optvar3)"""
+
+def test_cse_unhashable_constants():
+    # constants that cannot be hashed are compared
+    # by identity, so equal ones are not merged
+    bb = Block()
+    var0 = bb.getarg(0)
+    var1 = bb.add(var0, (1, [2]))
+    var2 = bb.add(var0, (1, [2]))
+
+    opt_bb = common_subexpr_elimination(bb)
+    assert bb_to_str(opt_bb, "optvar") == """\
+optvar0 = getarg(0)
+optvar1 = add(optvar0, (1, [2]))
+optvar2 = add(optvar0, (1, [2]))"""
+    assert len(optimise(bb)) == 3
+
+    bb = OptimisingBlock()
+    var0 = bb.getarg(0)
+    var1 = bb.add(var0, (1, [2]))
+    assert len(bb) == 2
 
 def test_strength_reduce():
     bb = Block()
@@ -380,6 +805,34 @@ def test_strength_reduce():
 optvar0 = getarg(0)
 optvar1 = lshift(optvar0, 1)"""
 
+def test_passes_in_sequence():
+    # running the passes one after the other must
+    # keep the representatives of the removed
+    # operations inside the output block
+    bb = Block()
+    var0 = bb.getarg(0)
+    var1 = bb.add(var0, var0)
+    var2 = bb.add(var0, var0)
+    var3 = bb.mul(var1, var2)
+
+    opt_bb = strength_reduce(common_subexpr_elimination(bb))
+    assert bb_to_str(opt_bb, "optvar") == """\
+optvar0 = getarg(0)
+optvar1 = lshift(optvar0, 1)
+optvar2 = mul(optvar1, optvar1)"""
+
+    bb = Block()
+    var0 = bb.getarg(0)
+    var1 = bb.add(var0, var0)
+    var2 = bb.add(var0, var0)
+    var3 = bb.mul(var1, var2)
+
+    opt_bb = optimise(common_subexpr_elimination(bb))
+    assert bb_to_str(opt_bb, "optvar") == """\
+optvar0 = getarg(0)
+optvar1 = lshift(optvar0, 1)
+optvar2 = mul(optvar1, optvar1)"""
+
 def test_single_pass():
     bb = Block()
     # constant folding
@@ -424,12 +877,83 @@ optvar4 = lshift(optvar3, 1)"""
 optvar0 = getarg(0)
 optvar1 = lshift(optvar0, 1)"""
 
+    # strength reduced adds share their lshift
+    bb = Block()
+    var0 = bb.getarg(0)
+    var1 = bb.add(var0, 0)
+    var2 = bb.add(var0, var0)
+    var3 = bb.add(var1, var1) # the same as var2
+    var4 = bb.lshift(var0, 1) # the same as var2
+    var5 = bb.mul(var3, var4)
+
+    opt_bb = optimise(bb)
+    assert bb_to_str(opt_bb, "optvar") == """\
+optvar0 = getarg(0)
+optvar1 = lshift(optvar0, 1)
+optvar2 = mul(optvar1, optvar1)"""
+
+def test_optimising_block():
+    # the same examples as in test_single_pass,
+    # but optimized while building the block
+    bb = OptimisingBlock()
+    var0 = bb.getarg(0)
+    var1 = bb.add(5, 4)
+    var2 = bb.add(var1, 10)
+    var3 = bb.add(var2, var0)
+    assert var2.value == 19
+    assert bb_to_str(bb, "optvar") == """\
+optvar0 = getarg(0)
+optvar1 = add(optvar0, 19)"""
+
+    bb = OptimisingBlock()
+    var0 = bb.getarg(0)
+    var1 = bb.getarg(1)
+    var2 = bb.add(var0, var1)
+    var3 = bb.add(var0, var1) # the same as var3
+    assert var3 is var2
+    var4 = bb.add(var2, 2)
+    var5 = bb.add(var3, 2) # the same as var4
+    var6 = bb.add(var4, var5)
+    assert bb_to_str(bb, "optvar") == """\
+optvar0 = getarg(0)
+optvar1 = getarg(1)
+optvar2 = add(optvar0, optvar1)
+optvar3 = add(optvar2, 2)
+optvar4 = lshift(optvar3, 1)"""
+
+    bb = OptimisingBlock()
+    var0 = bb.getarg(0)
+    var1 = bb.add(16, -16)
+    var2 = bb.add(var0, var1)
+    var3 = bb.add(0, var2)
+    assert var3 is var0
+    var4 = bb.add(var2, var3)
+    assert bb_to_str(bb, "optvar") == """\
+optvar0 = getarg(0)
+optvar1 = lshift(optvar0, 1)"""
+
+    bb = OptimisingBlock()
+    var0 = bb.getarg(0)
+    var1 = bb.add(var0, var0)
+    var2 = bb.add(var0, var0)
+    var3 = bb.lshift(var0, 1)
+    assert var2 is var1
+    assert var3 is var1
+    assert len(bb) == 2
+
 if __name__ == '__main__':
     print("---PyOpt---")
     test_convencience_block_construction()
     test_basicblock_to_str()
     test_union_find()
+    test_union_direction()
+    test_make_const()
+    test_path_compression()
     test_constfold_two_ops()
     test_cse()
+    test_cse_forwarded_constants()
+    test_cse_unhashable_constants()
     test_strength_reduce()
+    test_passes_in_sequence()
     test_single_pass()
+    test_optimising_block()